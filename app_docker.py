@@ -1,19 +1,39 @@
 import os
 import logging
+
+# Un thread OpenMP per chiamata tesseract: il parallelismo è fra pagine (OCR_EXECUTOR),
+# non dentro la singola pagina, dove i thread OpenMP si contenderebbero i core.
+# Va impostato prima che tesseract/libtesseract vengano caricati.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
 import pytesseract
-import google.generativeai as genai
+try:
+    import tesserocr  # binding diretto a libtesseract, opzionale
+except ImportError:
+    tesserocr = None
 from PIL import Image
-from flask import Flask, render_template, request, jsonify, send_file
-from docx import Document
-import fitz  # PyMuPDF
-from datetime import datetime
-import cv2
-import numpy as np
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
+from werkzeug.exceptions import HTTPException
+from datetime import date, datetime
 import traceback
-import pandas as pd
 import shutil
+import glob
 import threading
 import time
+import hashlib
+import secrets
+import json
+import tempfile
+import io
+import re
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+
+# cv2, numpy, fitz, docx, google.generativeai e openpyxl/python-calamine sono importati
+# solo nelle funzioni che li usano: avvio del worker (e risposta a /health) più rapido;
+# i più usati vengono poi pre-caricati in background (vedi _prewarm_imports)
+# così la prima richiesta non paga l'import
 
 # Logging
 logging.basicConfig(
@@ -23,18 +43,113 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Gemini API
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-
 # Flask setup
 app = Flask(__name__, template_folder="templates")
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB totali per upload
+# Richieste oltre il limite (più un margine per l'overhead multipart) vengono rifiutate
+# con 413 prima che Werkzeug ne legga e ne faccia lo spool del corpo
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES + 1024 * 1024
+UPLOAD_TOO_LARGE_MESSAGE = "File troppo grandi. Limite: 10MB totali"
 UPLOAD_FOLDER = "uploads"
 ARCHIVE_FOLDER = "archive"
+CACHE_FOLDER = "cache"  # riassunti Gemini già calcolati (a scadenza, svuotata da /reset)
+OCR_CACHE_FOLDER = os.path.join(CACHE_FOLDER, "ocr")  # testo OCR per file/pagina
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(ARCHIVE_FOLDER, exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
+
+# --- Stato dei task di elaborazione ---
+class BoundedTaskStore(OrderedDict):
+    """
+    Dizionario dei task con dimensione massima: oltre max_size vengono eliminati
+    i task più vecchi, così la memoria non cresce con le richieste servite.
+    I task scadono anche per età: quelli conclusi dopo finished_ttl secondi dalla fine,
+    tutti gli altri dopo ttl secondi dall'avvio (pulizia a ogni inserimento,
+    al massimo una volta ogni sweep_interval secondi).
+    """
+    def __init__(self, max_size, ttl=600, finished_ttl=120, sweep_interval=60):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.finished_ttl = finished_ttl
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self.lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+            self.purge_expired()
+            while len(self) > self.max_size:
+                self.popitem(last=False)
+
+    def purge_expired(self, force=False):
+        """Elimina i task scaduti. Restituisce quanti ne ha rimossi."""
+        now = time.time()
+        with self.lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return 0
+            self._last_sweep = now
+            expired = []
+            for key, info in self.items():
+                end_time = info.get("end_time")
+                if end_time is not None:
+                    if now - end_time > self.finished_ttl:
+                        expired.append(key)
+                elif now - info.get("start_time", now) > self.ttl:
+                    expired.append(key)
+            for key in expired:
+                super().pop(key, None)
+            return len(expired)
+
+    def pop(self, *args):
+        with self.lock:
+            return super().pop(*args)
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+
+processing_status = BoundedTaskStore(max_size=512)
 
-# Global per gestire timeout
-processing_status = {}
+FINAL_TASK_STATES = ("completed", "error", "timeout")
+CHECK_STATUS_WAIT = 5  # secondi di long-polling in /check_status
+_PRIVATE_TASK_KEYS = ("pages", "done_event")
+
+def _public_task_info(info):
+    """Copia serializzabile dello stato di un task (senza pagine parziali ed Event)."""
+    return {k: v for k, v in info.items() if k not in _PRIVATE_TASK_KEYS}
+
+# Pool condiviso per l'OCR parallelo delle pagine: tesseract (subprocess con
+# pytesseract, codice C con tesserocr) lavora fuori dal GIL, quindi i thread
+# scalano sui core. È a livello di modulo perché i thread, e le API tesserocr
+# che ciascuno tiene aperte, sopravvivano da un documento all'altro.
+OCR_MAX_WORKERS = os.cpu_count() or 1
+OCR_EXECUTOR = ThreadPoolExecutor(max_workers=OCR_MAX_WORKERS, thread_name_prefix="ocr")
+_tess_local = threading.local()
+
+# Pool per l'elaborazione degli upload: numero di thread limitato anche sotto
+# picchi di richieste (gli upload in eccesso restano in coda come "starting")
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_EXECUTOR = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+atexit.register(UPLOAD_EXECUTOR.shutdown, wait=False)
+# File dello stesso upload estratti in parallelo
+FILE_WORKERS = os.cpu_count() or 1
+# PyMuPDF non supporta l'uso da più thread, nemmeno con un Document per thread: ogni
+# chiamata a fitz (apertura, testo, digest, rendering, chiusura) passa da questo lock,
+# condiviso fra file dello stesso upload e fra upload diversi. Preprocessing e OCR
+# restano fuori dal lock e continuano a sovrapporsi sui pool.
+_fitz_lock = threading.Lock()
+
+# Sotto questa soglia di caratteri una pagina PDF è considerata una scansione da OCR
+MIN_DIGITAL_PAGE_CHARS = 10
+# Strato di testo "spazzatura" (tipico delle scansioni con OCR incorporato scadente):
+# blocchi cortissimi e fatti quasi solo di spazi -> la pagina va comunque in OCR
+JUNK_MAX_CHARS_PER_BLOCK = 20
+JUNK_MAX_NON_SPACE_RATIO = 0.3
+_WHITESPACE_RE = re.compile(r"\s+")
 
 # --- Configurazione Tesseract ---
 def configure_tesseract():
@@ -49,253 +164,1074 @@ def configure_tesseract():
                 logger.info(f"Configurato Tesseract da path: {path}")
                 break
 configure_tesseract()
+logger.info("Motore OCR: " + ("tesserocr (in-process)" if tesserocr is not None else "pytesseract (subprocess)"))
+
+OCR_LANGS = ("ita", "eng")
+
+def _warm_tessdata():
+    """
+    Legge una volta i .traineddata delle lingue OCR così finiscono nella page cache:
+    il primo caricamento del modello in tesseract legge dalla RAM invece che dal disco
+    effimero del container.
+    """
+    if tesserocr is not None:
+        tessdata_dir = tesserocr.get_languages()[0]
+    else:
+        tessdata_dir = os.getenv("TESSDATA_PREFIX") or next(
+            iter(sorted(glob.glob("/usr/share/tesseract-ocr/*/tessdata"))), "")
+    for lang in OCR_LANGS:
+        path = os.path.join(tessdata_dir, f"{lang}.traineddata")
+        try:
+            with open(path, "rb") as f:
+                while f.read(1 << 20):
+                    pass
+        except OSError:
+            pass
+
+def _prewarm_imports():
+    """Importa in background i moduli pesanti (OCR, Gemini, Word), dopo l'avvio del worker."""
+    start = time.time()
+    try:
+        import numpy  # noqa: F401
+        import cv2  # noqa: F401
+        import fitz  # noqa: F401
+        import google.generativeai  # noqa: F401
+        import docx  # noqa: F401
+        _warm_tessdata()
+    except Exception as e:
+        logger.error(f"Pre-caricamento moduli fallito: {e}")
+        return
+    logger.info(f"Moduli pre-caricati in {time.time() - start:.1f}s")
+
+# PREWARM_IMPORTS=0 per tenere l'RSS minimo finché non arriva un upload
+if os.getenv("PREWARM_IMPORTS", "1") == "1":
+    threading.Thread(target=_prewarm_imports, name="prewarm", daemon=True).start()
 
 # --- Preprocessing immagini OTTIMIZZATO ---
-def preprocess_image_for_ocr(image_path, fast_mode=True):
-    """Preprocessing ottimizzato con modalità veloce per Render"""
+OCR_MAX_SIDE_FAST = 1500  # lato lungo massimo in modalità veloce (px, ~130 DPI per un A4)
+OCR_MAX_SIDE_FULL = 2200  # lato lungo massimo nel secondo tentativo in modalità completa (px, ~190 DPI per un A4)
+OCR_MIN_HEIGHT = 100      # sotto questa altezza l'immagine viene ingrandita (px)
+
+def _sauvola_threshold(img, window=31, k=0.2, r=128.0):
+    """
+    Binarizzazione di Sauvola: soglia locale = media * (1 + k * (devstd / r - 1)).
+    Media e varianza locali vengono da box filter (immagini integrali), quindi il
+    costo per pixel non dipende dalla dimensione della finestra.
+    I calcoli successivi lavorano in place su un solo buffer float32: niente array
+    temporanei a piena risoluzione per ogni operazione (né l'int64 di np.where).
+    """
+    import cv2
+    import numpy as np
+    mean = cv2.boxFilter(img, cv2.CV_32F, (window, window), borderType=cv2.BORDER_REPLICATE)
+    buf = cv2.sqrBoxFilter(img, cv2.CV_32F, (window, window), borderType=cv2.BORDER_REPLICATE)
+    buf -= cv2.multiply(mean, mean)
+    np.maximum(buf, 0, out=buf)
+    np.sqrt(buf, out=buf)  # deviazione standard locale
+    # mean * (1 + k * (std / r - 1)) == mean * ((1 - k) + std * k / r)
+    buf *= k / r
+    buf += 1 - k
+    buf *= mean
+    binary = np.greater(img, buf).view(np.uint8)
+    binary *= 255  # in place: nessun secondo array uint8 per il risultato
+    return binary
+
+def _dark_on_light(binary):
+    """
+    Immagine binarizzata con testo nero su bianco, come la vuole tesseract: se più di
+    metà dei pixel è nera il testo era chiaro su fondo scuro (etichette di lastre ed
+    ecografie, screenshot in dark mode) e l'immagine viene invertita.
+    """
+    import cv2
+    if cv2.countNonZero(binary) < binary.size / 2:
+        return cv2.bitwise_not(binary)
+    return binary
+
+def _preprocess_array(img, fast_mode=True):
+    """Preprocessing di un'immagine grayscale già in memoria (numpy array)"""
+    import cv2
+    import numpy as np
     try:
-        img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        if img is None:
-            return None
-        
-        if fast_mode:
-            # Modalità veloce: solo resize e threshold semplice
-            h, w = img.shape
-            if max(h, w) > 1500:  # Ridimensiona se troppo grande
-                scale = 1500 / max(h, w)
-                img = cv2.resize(img, (int(w*scale), int(h*scale)))
-            
-            _, img = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-        else:
-            # Modalità completa
-            img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                        cv2.THRESH_BINARY, 31, 2)
-            img = cv2.medianBlur(img, 3)
-        
-        return img
+        # Ridimensiona se troppo grande: meno pixel = threshold e Tesseract più veloci.
+        # In modalità completa (secondo tentativo) si tiene più risoluzione per i caratteri piccoli
+        max_side = OCR_MAX_SIDE_FAST if fast_mode else OCR_MAX_SIDE_FULL
+        h, w = img.shape
+        scale = max_side / max(h, w)
+        if scale < 0.95:  # entro il 5% dal target non vale la pena ricampionare
+            img = cv2.resize(img, (int(w*scale), int(h*scale)), interpolation=cv2.INTER_AREA)
+        elif h < OCR_MIN_HEIGHT:
+            # immagini minuscole (ritagli, etichette): ingrandisci perché Tesseract le legga
+            scale = OCR_MIN_HEIGHT / h
+            img = cv2.resize(img, (int(w*scale), OCR_MIN_HEIGHT), interpolation=cv2.INTER_CUBIC)
+
+        # CLAHE (equalizzazione locale dell'istogramma): uniforma l'illuminazione
+        # prima della binarizzazione, costa un solo passaggio sull'immagine.
+        # Restituisce un array nuovo: da qui in poi blur, inversione e soglia lavorano
+        # in place sullo stesso buffer, senza copie a piena risoluzione
+        img = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(img)
+        # leggero blur contro il rumore di scansione (amplificato dal CLAHE), in entrambe le modalità
+        cv2.GaussianBlur(img, (3, 3), 0, dst=img)
+
+        if not fast_mode:
+            # Modalità completa (secondo tentativo di ocr_image_full): threshold locale per
+            # scansioni/foto con illuminazione non uniforme. Sauvola presuppone testo scuro su
+            # fondo chiaro, quindi un fondo scuro va invertito prima della soglia: a differenza
+            # di Otsu, invertire dopo (_dark_on_light) non basta, la soglia locale segue il fondo
+            if np.median(img) < 128:
+                cv2.bitwise_not(img, dst=img)
+            return _dark_on_light(_sauvola_threshold(img))
+
+        # Threshold globale di Otsu: un solo passaggio sull'immagine
+        cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=img)
+        return _dark_on_light(img)
     except Exception as e:
         logger.error(f"Errore preprocessing: {e}")
         return None
 
-def ocr_image_file(image_path, lang="ita+eng"):
+# Pagina bianca: nessun segno "a forma di carattere" che si stacchi dallo sfondo.
+# Si decide sul grayscale prima della binarizzazione: Otsu su un foglio vuoto
+# trasforma la grana della carta in metà pixel neri, mentre una sola riga di testo
+# (es. la conclusione di un referto) occupa meno dello 0.1% della pagina.
+BLANK_CONTRAST = 50      # differenza minima dallo sfondo (mediana) per un pixel di inchiostro
+GLYPH_MIN_HEIGHT = 4     # px, alla scala di OCR_MAX_SIDE_FAST
+GLYPH_MIN_AREA = 8       # px
+BLANK_MAX_GLYPHS = 2     # fino a questo numero di componenti la pagina è vuota
+
+def _is_blank(gray):
+    """
+    True se l'immagine grayscale non contiene testo: nessun pixel abbastanza diverso
+    dallo sfondo forma componenti connesse di dimensione da carattere.
+    Funziona anche con testo chiaro su sfondo scuro (conta la differenza, non il segno).
+    """
+    import cv2
+    import numpy as np
+    h, w = gray.shape
+    scale = OCR_MAX_SIDE_FAST / max(h, w)
+    if scale < 1:
+        gray = cv2.resize(gray, (max(int(w*scale), 1), max(int(h*scale), 1)), interpolation=cv2.INTER_AREA)
+    background = np.full_like(gray, int(np.median(gray)))
+    mask = (cv2.absdiff(gray, background) > BLANK_CONTRAST).astype(np.uint8)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]  # riga 0 = sfondo
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    glyphs = np.count_nonzero((heights >= GLYPH_MIN_HEIGHT) & (areas >= GLYPH_MIN_AREA)
+                              & (heights <= gray.shape[0] // 4))
+    return glyphs <= BLANK_MAX_GLYPHS
+
+def _jpeg_reduced_flag(image_bytes, max_side):
+    """
+    Flag di decodifica per un JPEG: libjpeg sa decodificare direttamente a 1/2, 1/4, 1/8
+    (scala DCT), molto più veloce che decodificare tutto e poi ridimensionare.
+    Sceglie la riduzione più forte che lascia il lato lungo almeno a max_side; per i
+    formati non JPEG OpenCV ignorerebbe la scala DCT, quindi restano a piena risoluzione.
+    """
+    import cv2
+    if image_bytes[:2] != b"\xff\xd8":
+        return cv2.IMREAD_GRAYSCALE
+    try:
+        # PIL legge solo l'header per le dimensioni, senza decodificare i pixel
+        w, h = Image.open(io.BytesIO(image_bytes)).size
+    except Exception:
+        return cv2.IMREAD_GRAYSCALE
+    for factor, flag in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                         (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                         (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+        if max(w, h) / factor >= max_side:
+            return flag
+    return cv2.IMREAD_GRAYSCALE
+
+def _decode_gray(image_bytes, max_side=OCR_MAX_SIDE_FAST):
+    """Decodifica un'immagine codificata in grayscale (JPEG grandi a scala ridotta); None se illeggibile."""
+    import cv2
+    import numpy as np
+    flag = _jpeg_reduced_flag(image_bytes, max_side)
+    return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), flag)
+
+def _tess_api(lang="ita+eng"):
+    """
+    PyTessBaseAPI del thread corrente per la lingua richiesta, creata al primo uso e poi
+    riusata: niente subprocess né ricaricamento del modello a ogni immagine.
+    L'API non è thread-safe, quindi ogni thread ha la sua.
+    """
+    apis = getattr(_tess_local, "apis", None)
+    if apis is None:
+        apis = _tess_local.apis = {}
+    if lang not in apis:
+        apis[lang] = tesserocr.PyTessBaseAPI(lang=lang)
+    return apis[lang]
+
+def _ocr_pil(pil_img, lang="ita+eng"):
+    """OCR di un'immagine PIL: tesserocr in-process se installato, altrimenti pytesseract."""
+    if tesserocr is not None:
+        api = _tess_api(lang)
+        api.SetImage(pil_img)
+        return api.GetUTF8Text() or ""
+    return pytesseract.image_to_string(pil_img, lang=lang) or ""
+
+def ocr_image_array(img, lang="ita+eng"):
     """
-    OCR su immagine con preprocessing (usa preprocess_image_for_ocr se disponibile).
+    OCR su immagine già in memoria (numpy array grayscale).
     Restituisce stringa (vuota se errore).
     """
     try:
-        # usa la funzione di preprocessing già presente nel file
-        processed = preprocess_image_for_ocr(image_path, fast_mode=True)
-        if processed is not None:
-            # processed è un numpy array (grayscale) -> converti in PIL
-            pil_img = Image.fromarray(processed)
-        else:
-            pil_img = Image.open(image_path)
-        text = pytesseract.image_to_string(pil_img, lang=lang)
-        return text or ""
+        return _ocr_pil(Image.fromarray(img), lang=lang)
+    except Exception as e:
+        logger.error(f"OCR image error: {e}")
+        return ""
+
+# Secondo tentativo in modalità completa: se Otsu globale (modalità veloce) su una pagina
+# non bianca legge meno di questi caratteri, di solito l'illuminazione non è uniforme
+# (foto da telefono, ombre, scansioni sbiadite) e serve la soglia locale di Sauvola.
+OCR_RETRY_MIN_CHARS = 20
+
+def _ocr_text_poor(text):
+    """True se l'OCR ha letto troppo poco testo (spazi esclusi) per fidarsi del risultato."""
+    return sum(not c.isspace() for c in text) < OCR_RETRY_MIN_CHARS
+
+def ocr_image_full(gray, fallback_text="", lang="ita+eng"):
+    """
+    Secondo tentativo OCR in modalità completa (Sauvola) su un grayscale a OCR_MAX_SIDE_FULL.
+    Restituisce il testo più lungo fra questo e fallback_text (il risultato della modalità veloce).
+    """
+    processed = _preprocess_array(gray, fast_mode=False)
+    if processed is None:
+        return fallback_text
+    text = ocr_image_array(processed, lang=lang)
+    if len(text.strip()) > len(fallback_text.strip()):
+        return text
+    return fallback_text
+
+def ocr_image_bytes(image_bytes, lang="ita+eng"):
+    """
+    OCR su immagine codificata (PNG/JPEG/...) con preprocessing (_preprocess_array se decodificabile).
+    Se la modalità veloce legge poco testo riprova in modalità completa (ocr_image_full).
+    Restituisce stringa (vuota se errore o immagine senza testo).
+    """
+    try:
+        gray = _decode_gray(image_bytes)
+        if gray is not None:
+            if _is_blank(gray):
+                return ""
+            processed = _preprocess_array(gray)
+            text = ocr_image_array(gray if processed is None else processed, lang=lang)
+            if _ocr_text_poor(text):
+                full = _decode_gray(image_bytes, OCR_MAX_SIDE_FULL)
+                if full is not None:
+                    text = ocr_image_full(full, text, lang=lang)
+            return text
+        return _ocr_pil(Image.open(io.BytesIO(image_bytes)), lang=lang)
     except Exception as e:
         logger.error(f"OCR image error: {e}")
         return ""
 
+def ocr_image_batch(images, lang="ita+eng"):
+    """
+    OCR di più immagini (numpy array grayscale). Con tesserocr le immagini passano una
+    alla volta dall'API persistente del thread; con pytesseract vengono scritte in una
+    cartella temporanea e date a un solo processo tesseract tramite file elenco, così
+    avvio del processo e caricamento del modello avvengono una volta per lotto.
+    Restituisce un testo per immagine, nello stesso ordine (stringhe vuote se errore).
+    """
+    if not images:
+        return []
+    if tesserocr is not None:
+        return [ocr_image_array(img, lang=lang) for img in images]
+
+    import cv2
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_paths = []
+            for k, img in enumerate(images):
+                # PGM non compresso: niente codifica PNG da parte nostra né decodifica in tesseract
+                img_path = os.path.join(tmp_dir, f"p{k:04d}.pgm")
+                cv2.imwrite(img_path, img)
+                image_paths.append(img_path)
+            list_path = os.path.join(tmp_dir, "images.txt")
+            with open(list_path, "w") as f:
+                f.write("\n".join(image_paths) + "\n")
+
+            text = pytesseract.image_to_string(list_path, lang=lang) or ""
+        # tesseract separa le pagine con un form feed
+        pages = text.split("\f")
+        return [pages[k] if k < len(pages) else "" for k in range(len(images))]
+    except Exception as e:
+        logger.error(f"OCR batch error: {e}")
+        return [""] * len(images)
+
+def _page_digital_text(page):
+    """
+    Testo digitale di una pagina PDF e se serve comunque l'OCR.
+    Usa i blocchi di testo (stesso contenuto di get_text("text")) per distinguere
+    una pagina davvero testuale da uno strato di testo vuoto o spazzatura.
+    """
+    blocks = [b for b in page.get_text("blocks") if b[6] == 0]  # 0 = blocco di testo
+    text = "".join(b[4] if b[4].endswith("\n") else b[4] + "\n" for b in blocks)
+    non_space = len(_WHITESPACE_RE.sub("", text))
+    if non_space <= MIN_DIGITAL_PAGE_CHARS:
+        return text, True
+    chars_per_block = len(text) / len(blocks)
+    junk = (chars_per_block < JUNK_MAX_CHARS_PER_BLOCK
+            and non_space / len(text) < JUNK_MAX_NON_SPACE_RATIO)
+    return text, junk
+
+def _render_page_gray(page, max_side=OCR_MAX_SIDE_FAST, max_dpi=300):
+    """
+    Renderizza una pagina PDF direttamente in un numpy array grayscale (niente file temporanei).
+    I DPI sono scelti perché il lato lungo arrivi già a max_side: renderizzare a 300 DPI
+    fissi per poi ridimensionare in preprocessing sprecherebbe la maggior parte dei pixel.
+    """
+    import fitz
+    import numpy as np
+    dpi = min(max_dpi, int(72 * max_side / max(page.rect.width, page.rect.height, 1)))
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+
+
+
+def _xlsx_cell_text(v):
+    """
+    Testo di una cella con lo stesso aspetto per calamine e openpyxl:
+    vuota -> "", 250.0 -> "250", data -> "2024-01-05 00:00:00".
+    """
+    if v is None:
+        return ""
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    if isinstance(v, date) and not isinstance(v, datetime):
+        v = datetime(v.year, v.month, v.day)
+    return str(v)
+
+def xlsx_to_text(data):
+    """
+    Testo di una cartella .xlsx (bytes), un foglio dopo l'altro, celle separate da tab.
+    Usa python-calamine (parser in Rust) se installato, altrimenti openpyxl in streaming.
+    """
+    parts = []
+    try:
+        from python_calamine import CalamineWorkbook
+    except ImportError:
+        CalamineWorkbook = None
+
+    if CalamineWorkbook is not None:
+        wb = CalamineWorkbook.from_filelike(io.BytesIO(data))
+        for name in wb.sheet_names:
+            parts.append(f"--- Foglio: {name} ---")
+            for row in wb.get_sheet_by_name(name).to_python():
+                parts.append("\t".join(map(_xlsx_cell_text, row)))
+        return "\n".join(parts)
+
+    from openpyxl import load_workbook
+
+    # lettura in streaming riga per riga: niente DataFrame in memoria
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            parts.append(f"--- Foglio: {ws.title} ---")
+            for row in ws.iter_rows(values_only=True):
+                parts.append("\t".join(map(_xlsx_cell_text, row)))
+    finally:
+        wb.close()
+    return "\n".join(parts)
+
+# --- Cache su disco: limiti ---
+# Le cache contengono testo di referti: scadono dopo CACHE_TTL secondi dalla scrittura,
+# hanno un numero massimo di file e vengono svuotate da /reset.
+CACHE_TTL = 24 * 3600
+CACHE_PRUNE_INTERVAL = 60  # secondi minimi fra due pulizie della stessa cartella
+_cache_pruned_at = {}      # cartella -> ultima pulizia
+_cache_prune_lock = threading.Lock()
+
+def _cache_file_fresh(path):
+    """True se il file di cache esiste e non è scaduto."""
+    try:
+        return time.time() - os.path.getmtime(path) <= CACHE_TTL
+    except OSError:
+        return False
 
+def _prune_cache_folder(folder, max_files):
+    """
+    Elimina dalla cartella i file di cache scaduti e, oltre max_files, i più vecchi.
+    Al massimo una volta ogni CACHE_PRUNE_INTERVAL secondi per cartella.
+    """
+    now = time.time()
+    with _cache_prune_lock:
+        if now - _cache_pruned_at.get(folder, 0) < CACHE_PRUNE_INTERVAL:
+            return
+        _cache_pruned_at[folder] = now
+
+    entries = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(".txt"):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass
+    except OSError:
+        return
+    entries.sort(reverse=True)  # dal più recente
+    for k, (mtime, path) in enumerate(entries):
+        if k >= max_files or now - mtime > CACHE_TTL:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+# --- Cache OCR su disco ---
+# Chiave: sha256 dei byte del file caricato (immagini) o del contenuto della singola
+# pagina (PDF). Un referto ricaricato non passa più da rendering, preprocessing e tesseract.
+OCR_CACHE_MAX_FILES = 2000
+
+def _ocr_cache_path(key):
+    return os.path.join(OCR_CACHE_FOLDER, f"{key}.txt")
+
+def _ocr_cache_get(key):
+    """Testo OCR già calcolato (e non scaduto) per questa chiave, oppure None."""
+    cache_path = _ocr_cache_path(key)
+    if not _cache_file_fresh(cache_path):
+        return None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _ocr_cache_put(key, text):
+    # testo vuoto non salvato: potrebbe essere un errore OCR (le funzioni OCR
+    # restituiscono "" in caso di errore), che non va reso permanente
+    if not text.strip():
+        return
+    # scrittura atomica: file temporaneo + rename
+    cache_path = _ocr_cache_path(key)
+    tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.error(f"Errore scrittura cache OCR: {e}")
+    _prune_cache_folder(OCR_CACHE_FOLDER, OCR_CACHE_MAX_FILES)
+
+def _page_digest(doc, page):
+    """
+    sha256 del contenuto di una pagina PDF: content stream, immagini e form XObject
+    che usa, dimensioni e rotazione. Non dipende dalle altre pagine, quindi la cache
+    OCR vale anche per le pagine invariate di un PDF modificato (pagine aggiunte o tolte).
+    """
+    h = hashlib.sha256(f"{page.rect}|{page.rotation}".encode())
+    h.update(page.read_contents())
+    for img in page.get_images(full=True):
+        h.update(doc.xref_stream_raw(img[0]) or b"")
+    for xobj in page.get_xobjects():
+        h.update(doc.xref_stream_raw(xobj[0]) or b"")
+    return h.hexdigest()
+
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+# Figli di un run (w:r) che diventano testo, con la stessa resa di python-docx Paragraph.text
+_W_T, _W_TAB, _W_BR, _W_CR = (_W_NS + tag for tag in ("t", "tab", "br", "cr"))
+
+def _docx_paragraph_text(p):
+    """Testo di un paragrafo w:p: w:t così com'è, w:tab -> tab, w:br/w:cr -> a capo."""
+    parts = []
+    # solo i run: i w:tab dentro w:pPr/w:tabs sono definizioni di tabulazioni, non testo
+    for run in p.iter(_W_NS + "r"):
+        for child in run:
+            tag = child.tag
+            if tag == _W_T:
+                parts.append(child.text or "")
+            elif tag == _W_TAB:
+                parts.append("\t")
+            elif tag == _W_CR or (tag == _W_BR and child.get(_W_NS + "type") in (None, "textWrapping")):
+                # le interruzioni di pagina/colonna non producono testo, come in python-docx
+                parts.append("\n")
+    return "".join(parts)
+
+def docx_to_text(data):
+    """
+    Testo di un documento .docx (bytes), un paragrafo per riga, tabelle comprese.
+    Scorre direttamente l'albero lxml (w:p / w:r) invece dei wrapper Python di
+    doc.paragraphs, che costano un oggetto per paragrafo e run.
+    """
+    from docx import Document
+    body = Document(io.BytesIO(data)).element.body
+    return "\n".join(_docx_paragraph_text(p) for p in body.iter(_W_NS + "p"))
 
 # --- Estrazione testo OTTIMIZZATA ---
-def extract_text_from_file_async(file_path, task_id):
+def extract_text_from_file_async(filename, data, task_id, on_page=None):
     """
-    Estrae testo da singolo file (PDF testuale o PDF scansione -> OCR pagina per pagina).
+    Estrae testo da singolo file caricato, già in memoria come bytes
+    (PDF testuale o PDF scansione -> OCR pagina per pagina, immagini, .docx, .xlsx, .txt).
     Aggiorna processing_status[task_id] con {'status','progress','result'}.
+    Se indicato, on_page(indice_pagina, testo) viene chiamato appena ogni pagina è pronta
+    (i file non PDF contano come un'unica pagina).
     """
-    processing_status[task_id] = {"status": "processing", "progress": 0, "start_time": time.time()}
+    # riferimento locale: l'elaborazione continua anche se il task viene rimosso dallo store
+    status = processing_status[task_id] = {"status": "processing", "progress": 0, "start_time": time.time()}
     try:
-        ext = os.path.splitext(file_path)[1].lower()
+        ext = os.path.splitext(filename)[1].lower()
         result_text = ""
 
         if ext == ".pdf":
-            # apri PDF con PyMuPDF (fitz)
-            doc = fitz.open(file_path)
-            total_pages = len(doc)
-            for i, page in enumerate(doc):
-                # aggiorna progress parziale
-                processing_status[task_id]["progress"] = int((i / max(total_pages,1)) * 60)
-
-                # prova estrazione testo digitale
-                try:
-                    page_text = page.get_text("text") or ""
-                except Exception:
-                    page_text = ""
-
-                if page_text.strip():
-                    result_text += f"--- Pagina {i+1} ---\n{page_text}\n\n"
-                else:
-                    # pagina immagine: rendi immagine ad alta risoluzione e OCR
-                    pix = page.get_pixmap(dpi=300)
-                    temp_img = os.path.join(UPLOAD_FOLDER, f"ocr_{os.path.basename(file_path)}_p{i+1}.png")
-                    pix.save(temp_img)
-                    ocr_t = ocr_image_file(temp_img)
-                    result_text += f"--- Pagina {i+1} (OCR) ---\n{ocr_t}\n\n"
-                    # pulizia immagine temporanea
+            import fitz  # PyMuPDF
+
+            # apri PDF con PyMuPDF (fitz); ogni accesso al documento sotto _fitz_lock,
+            # preso pagina per pagina così più PDF avanzano alternandosi
+            with _fitz_lock:
+                doc = fitz.open(stream=data, filetype="pdf")
+                total_pages = len(doc)
+            try:
+                # testo digitale di tutte le pagine in un colpo solo
+                chunks = []
+                ocr_indices = []  # pagine senza testo digitale utilizzabile
+                for i in range(total_pages):
                     try:
-                        os.remove(temp_img)
+                        with _fitz_lock:
+                            text, needs_ocr = _page_digital_text(doc[i])
                     except Exception:
-                        pass
+                        text, needs_ocr = "", True
+                    chunks.append(text)
+                    if needs_ocr:
+                        ocr_indices.append(i)
+
+                page_texts = [f"--- Pagina {i+1} ---\n{t}\n\n" for i, t in enumerate(chunks)]
+                done = total_pages - len(ocr_indices)
+                status["progress"] = int((done / max(total_pages,1)) * 90)
+                if on_page:
+                    ocr_set = set(ocr_indices)
+                    for i in range(total_pages):
+                        if i not in ocr_set:
+                            on_page(i, page_texts[i])
 
-                processing_status[task_id]["progress"] = int(((i + 1) / max(total_pages,1)) * 90)
+                if ocr_indices:
+                    # pagine immagine renderizzate e preprocessate in memoria per l'OCR
+                    ocr_pages = []  # (indice pagina, immagine preprocessata)
+                    page_keys = {}  # indice pagina -> chiave cache OCR
+                    for i in ocr_indices:
+                        try:
+                            with _fitz_lock:
+                                page_keys[i] = _page_digest(doc, doc[i])
+                        except Exception:
+                            page_keys[i] = None  # pagina senza cache, OCR normale
+                        cached = _ocr_cache_get(page_keys[i]) if page_keys[i] else None
+                        if cached is not None:
+                            page_texts[i] = f"--- Pagina {i+1} (OCR) ---\n{cached}\n\n"
+                            if on_page:
+                                on_page(i, page_texts[i])
+                            done += 1
+                            continue
+                        with _fitz_lock:
+                            img = _render_page_gray(doc[i])
+                        if _is_blank(img):
+                            # pagina bianca (retro, separatore): nessuna chiamata a tesseract
+                            page_texts[i] = f"--- Pagina {i+1} (OCR) ---\n\n\n"
+                            if on_page:
+                                on_page(i, page_texts[i])
+                            done += 1
+                            continue
+                        processed = _preprocess_array(img)
+                        ocr_pages.append((i, img if processed is None else processed))
+                    status["progress"] = int((done / max(total_pages,1)) * 90)
 
-            doc.close()
+                    # con pytesseract un lotto per worker (un processo tesseract per lotto);
+                    # con tesserocr non c'è costo di avvio, quindi una pagina per lotto
+                    n_batches = len(ocr_pages) if tesserocr is not None else min(OCR_MAX_WORKERS, len(ocr_pages))
+                    batches = [ocr_pages[k::n_batches] for k in range(n_batches)]
+                    futures = {OCR_EXECUTOR.submit(ocr_image_batch, [img for _, img in batch]): batch
+                               for batch in batches}
+
+                    def page_done(i, text):
+                        if page_keys[i]:
+                            _ocr_cache_put(page_keys[i], text)
+                        page_texts[i] = f"--- Pagina {i+1} (OCR) ---\n{text}\n\n"
+                        if on_page:
+                            on_page(i, page_texts[i])
+
+                    retry = {}  # pagine con poco testo -> testo della modalità veloce
+                    for future in as_completed(futures):
+                        batch = futures[future]
+                        for (i, _), text in zip(batch, future.result()):
+                            if _ocr_text_poor(text):
+                                retry[i] = text
+                            else:
+                                page_done(i, text)
+                        done += len(batch)
+                        status["progress"] = int((done / max(total_pages,1)) * 90)
+
+                    # secondo tentativo in modalità completa: pagina ri-renderizzata a
+                    # OCR_MAX_SIDE_FULL e soglia locale di Sauvola
+                    futures = {}
+                    for i, text in retry.items():
+                        with _fitz_lock:
+                            img = _render_page_gray(doc[i], max_side=OCR_MAX_SIDE_FULL)
+                        futures[OCR_EXECUTOR.submit(ocr_image_full, img, text)] = i
+                    for future in as_completed(futures):
+                        page_done(futures[future], future.result())
+            finally:
+                with _fitz_lock:
+                    doc.close()
+
+            result_text = "".join(page_texts)
 
         elif ext in [".png", ".jpg", ".jpeg", ".tiff", ".bmp"]:
-            # immagine singola -> OCR
-            result_text = ocr_image_file(file_path)
-            processing_status[task_id]["progress"] = 100
+            # immagine singola -> OCR (dalla cache se già vista)
+            key = hashlib.sha256(data).hexdigest()
+            result_text = _ocr_cache_get(key)
+            if result_text is None:
+                # sul pool OCR come le pagine PDF: concorrenza di tesseract limitata e,
+                # con tesserocr, API (e modello) dei thread del pool riusate fra upload
+                result_text = OCR_EXECUTOR.submit(ocr_image_bytes, data).result()
+                _ocr_cache_put(key, result_text)
+            status["progress"] = 100
+
+        elif ext == ".docx":
+            result_text = docx_to_text(data)
+            status["progress"] = 100
+
+        elif ext == ".xlsx":
+            result_text = xlsx_to_text(data)
+            status["progress"] = 100
 
         elif ext == ".txt":
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                result_text = f.read()
-            processing_status[task_id]["progress"] = 100
+            result_text = data.decode("utf-8", errors="ignore")
+            status["progress"] = 100
 
         else:
             result_text = f"[Formato non supportato: {ext}]"
-            processing_status[task_id]["progress"] = 100
+            status["progress"] = 100
 
-        processing_status[task_id]["status"] = "completed"
-        processing_status[task_id]["result"] = result_text
+        if on_page and ext != ".pdf":
+            on_page(0, result_text)
+
+        status["status"] = "completed"
+        status["result"] = result_text
 
     except Exception as e:
         logger.error(traceback.format_exc())
-        processing_status[task_id]["status"] = "error"
-        processing_status[task_id]["result"] = str(e)
+        status["status"] = "error"
+        status["result"] = str(e)
 
 
 # --- Prompt generator ---
-def get_prompt(base_type, custom, text):
-    # Limita il testo per evitare timeout API
-    max_chars = 8000
-    if len(text) > max_chars:
-        text = text[:max_chars] + "\n...[testo troncato per performance]"
-    
-    if base_type == "simple":
-        return f"Analizza questo referto medico e fornisci un riassunto chiaro e semplice per un paziente (max 300 parole):\n\n{text}"
-    elif base_type == "intermediate":
-        return f"""Analizza questo referto medico e fornisci un riassunto strutturato (max 400 parole):
+# Template precalcolati all'avvio come (prefisso, suffisso) attorno al testo del referto:
+# get_prompt fa un solo "".join invece di ricostruire l'f-string a ogni richiesta
+_PROMPTS = {
+    "simple": ("Analizza questo referto medico e fornisci un riassunto chiaro e semplice per un paziente (max 300 parole):\n\n", ""),
+    "intermediate": ("""Analizza questo referto medico e fornisci un riassunto strutturato (max 400 parole):
         - Diagnosi principale
         - Parametri fuori norma con valori numerici
         - Terapie o raccomandazioni
         Testo referto:
-        {text}"""
-    elif base_type == "detailed":
-        return f"""Analisi tecnica del referto medico (max 500 parole):
+        """, ""),
+    "detailed": ("""Analisi tecnica del referto medico (max 500 parole):
         - Diagnosi e classificazioni mediche
         - Valori di laboratorio con range normali
         - Correlazioni cliniche
         Testo referto:
-        {text}"""
-    elif base_type == "custom" and custom:
-        return f"{custom}\n\nTesto referto:\n{text}"
-    return f"Riassumi il seguente referto medico:\n{text}"
+        """, ""),
+    "default": ("Riassumi il seguente referto medico:\n", ""),
+}
+# Limite del testo nel prompt espresso in token: il modello flash ha una finestra ampia,
+# 8000 caratteri fissi (~2000 token) ne usavano una frazione minima.
+# Stima prudente di 3 caratteri per token (l'italiano medico ne ha ~4), senza chiamare count_tokens.
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "30000"))
+CHARS_PER_TOKEN = 3
+PROMPT_MAX_CHARS = MAX_INPUT_TOKENS * CHARS_PER_TOKEN
+PROMPT_TRUNCATED_NOTE = "\n...[testo troncato per performance]"
+
+def get_prompt(base_type, custom, text):
+    if base_type == "custom" and custom:
+        prefix, suffix = f"{custom}\n\nTesto referto:\n", ""
+    else:
+        prefix, suffix = _PROMPTS.get(base_type, _PROMPTS["default"])
+
+    # Limita il testo per evitare timeout API (senza creare una copia troncata intermedia)
+    if len(text) > PROMPT_MAX_CHARS:
+        return "".join((prefix, text[:PROMPT_MAX_CHARS], PROMPT_TRUNCATED_NOTE, suffix))
+    return "".join((prefix, text, suffix))
 
 # --- Summarization OTTIMIZZATA ---
+GEMINI_MODEL_NAME = "gemini-2.5-flash-lite-preview-09-2025"
+GEMINI_ERROR_MESSAGE = "⚠️ Servizio temporaneamente non disponibile. Riprova tra qualche minuto.\nErrore: {}"
+
+# Un solo modello condiviso fra le richieste invece di uno nuovo per chiamata,
+# creato alla prima richiesta (double-checked locking)
+_model = None
+_model_lock = threading.Lock()
+
+def _get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+                _model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+    return _model
+
+# Cache dei riassunti: LRU in memoria + file su disco indicizzati dallo SHA-256 del prompt
+SUMMARY_CACHE_SIZE = 256
+SUMMARY_DISK_CACHE_MAX_FILES = 1000  # su disco valgono anche CACHE_TTL e /reset
+_summary_cache = OrderedDict()
+_summary_cache_lock = threading.Lock()
+
+def _summary_cache_path(key):
+    return os.path.join(CACHE_FOLDER, f"{key}.txt")
+
+def _summary_cache_get(key):
+    """Riassunto già calcolato per questo prompt, oppure None."""
+    with _summary_cache_lock:
+        if key in _summary_cache:
+            _summary_cache.move_to_end(key)
+            return _summary_cache[key]
+
+    cache_path = _summary_cache_path(key)
+    if not _cache_file_fresh(cache_path):
+        return None
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            summary = f.read()
+    except OSError:
+        return None
+    _summary_cache_put(key, summary, persist=False)
+    return summary
+
+def _summary_cache_put(key, summary, persist=True):
+    with _summary_cache_lock:
+        _summary_cache[key] = summary
+        _summary_cache.move_to_end(key)
+        while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+
+    if persist:
+        # scrittura atomica: file temporaneo + rename
+        cache_path = _summary_cache_path(key)
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(summary)
+        os.replace(tmp_path, cache_path)
+        _prune_cache_folder(CACHE_FOLDER, SUMMARY_DISK_CACHE_MAX_FILES)
+
+def _prompt_key(prompt):
+    # spazi e a capo normalizzati: lo stesso referto con spaziatura diversa
+    # (riga vuota in coda, OCR ripetuto) riusa il riassunto in cache
+    return hashlib.sha256(" ".join(prompt.split()).encode("utf-8")).hexdigest()
+
+def _generate_cached(prompt):
+    """Chiamata Gemini passando dalla cache dei riassunti; solleva eccezione in caso di errore."""
+    key = _prompt_key(prompt)
+    cached = _summary_cache_get(key)
+    if cached is not None:
+        return cached
+
+    # Timeout più basso per Gemini
+    response = _get_model().generate_content(prompt)
+    summary = response.text
+    _summary_cache_put(key, summary)
+    return summary
+
 def generate_summary(prompt):
     try:
-        model = genai.GenerativeModel("gemini-2.5-flash-lite-preview-09-2025")
-        # Timeout più basso per Gemini
-        response = model.generate_content(prompt)
-        return response.text
+        return _generate_cached(prompt)
     except Exception as e:
         logger.error(f"Errore Gemini: {traceback.format_exc()}")
-        return f"⚠️ Servizio temporaneamente non disponibile. Riprova tra qualche minuto.\nErrore: {str(e)}"
+        return GEMINI_ERROR_MESSAGE.format(str(e))
+
+def stream_summary(prompt):
+    """
+    Come generate_summary ma restituisce il riassunto a blocchi, man mano che Gemini li produce.
+    Il testo completo finisce in cache solo se lo stream termina senza errori.
+    """
+    key = _prompt_key(prompt)
+    cached = _summary_cache_get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    for chunk in _get_model().generate_content(prompt, stream=True):
+        parts.append(chunk.text)
+        yield chunk.text
+    _summary_cache_put(key, "".join(parts))
+
+# --- Referti lunghi: map-reduce prima del prompt finale ---
+SECTION_MAX_CHARS = PROMPT_MAX_CHARS  # ogni sezione sta in una singola chiamata
+MAX_SECTIONS = 100                    # tetto di chiamate per referto (~9M caratteri), oltre si tronca con avviso
+GEMINI_MAX_PARALLEL = 4               # chiamate Gemini contemporanee per referto
+SECTION_PROMPT = ("Riassumi questa sezione di un referto medico mantenendo diagnosi, "
+                  "valori fuori norma con i loro numeri e terapie:\n\n")
+
+def _split_text(text, max_chars):
+    """Divide il testo in sezioni di al massimo max_chars, rispettando i paragrafi quando possibile."""
+    sections, current, size = [], [], 0
+    for para in text.split("\n\n"):
+        if current and size + len(para) > max_chars:
+            sections.append("\n\n".join(current))
+            current, size = [], 0
+        # paragrafi più lunghi del limite vengono spezzati a forza
+        while len(para) > max_chars:
+            sections.append(para[:max_chars])
+            para = para[max_chars:]
+        current.append(para)
+        size += len(para) + 2
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+def condense_text(text):
+    """
+    Se il referto supera il limite del prompt, lo riassume a sezioni in parallelo (map)
+    e restituisce l'unione dei riassunti parziali, su cui poi si costruisce il prompt finale (reduce).
+    Se l'unione è ancora oltre il limite viene condensata di nuovo, così le ultime
+    sezioni (spesso gli esami di laboratorio) non vengono tagliate da get_prompt.
+    I riassunti di sezione passano dalla cache; se Gemini fallisce si torna al testo
+    originale, che get_prompt tronca come sempre.
+    """
+    if len(text) <= PROMPT_MAX_CHARS:
+        return text
+
+    sections = _split_text(text, SECTION_MAX_CHARS)
+    dropped_note = ""
+    if len(sections) > MAX_SECTIONS:
+        dropped = sum(len(section) for section in sections[MAX_SECTIONS:])
+        logger.warning(f"Referto oltre {MAX_SECTIONS} sezioni: {dropped} caratteri finali non analizzati")
+        dropped_note = f"\n\n[...{dropped} caratteri finali del referto non analizzati]"
+        sections = sections[:MAX_SECTIONS]
+    try:
+        with ThreadPoolExecutor(max_workers=min(GEMINI_MAX_PARALLEL, len(sections))) as executor:
+            partials = list(executor.map(_generate_cached, [SECTION_PROMPT + section for section in sections]))
+    except Exception:
+        logger.error(f"Errore riassunto sezioni: {traceback.format_exc()}")
+        return text
+    logger.info(f"Referto lungo ({len(text)} caratteri) condensato in {len(sections)} sezioni")
+    condensed = "\n\n".join(partials)
+    if len(partials) > 1 and PROMPT_MAX_CHARS < len(condensed) < len(text) // 2:
+        # ogni passaggio riduce il testo di un fattore ~SECTION_MAX_CHARS / lunghezza riassunto;
+        # se non lo dimezza ci si ferma e tronca get_prompt (nessun ciclo senza fine)
+        condensed = condense_text(condensed)
+    return condensed + dropped_note
 
 # --- Word export ---
+# Il .docx viene generato in memoria e in background: /analyze risponde subito con il
+# doc_id e /download-summary/<doc_id> attende il documento solo se è ancora in preparazione.
+# doc_id = sha256 di riassunto e testo: ogni analisi ha il suo documento (niente file
+# unico condiviso fra utenti), lo stesso contenuto non viene rigenerato e fa da ETag.
+DOC_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="docx")
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+word_docs = BoundedTaskStore(max_size=32, ttl=3600)  # doc_id -> {"start_time", "future"}
+
 def create_word_doc(summary, full_text):
+    """Documento Word con riassunto e testo integrale, come bytes."""
+    from docx import Document
     doc = Document()
     doc.add_heading("Riassunto Referto Medico", 0)
     doc.add_paragraph(summary)
     doc.add_page_break()
     doc.add_heading("Testo Integrale", level=1)
     doc.add_paragraph(full_text)
-    file_path = os.path.join(ARCHIVE_FOLDER, "riassunto_referto.docx")
-    doc.save(file_path)
-    return file_path
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+def create_word_doc_async(summary, full_text):
+    """Accoda create_word_doc sul DOC_EXECUTOR (se non già presente) e restituisce il doc_id."""
+    doc_id = hashlib.sha256(f"{summary}\0{full_text}".encode("utf-8")).hexdigest()
+    with word_docs.lock:
+        if doc_id not in word_docs:
+            word_docs[doc_id] = {"start_time": time.time(),
+                                 "future": DOC_EXECUTOR.submit(create_word_doc, summary, full_text)}
+    return doc_id
 
 # --- Routes OTTIMIZZATE ---
+# Durata massima di una connessione /stream_status (secondi)
+STREAM_STATUS_TIMEOUT = 600
+
+def _sse(payload):
+    """Serializza un evento Server-Sent Events."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+# La pagina non ha variabili di template: renderizzata una volta, poi servita dalla memoria
+_index_html = None
+
+# Firme (magic bytes) attese per estensione: un file rinominato o corrotto viene
+# rifiutato prima di arrivare a PyMuPDF/OpenCV/openpyxl. .txt non ha firma.
+_FILE_SIGNATURES = {
+    ".pdf": (b"%PDF",),
+    ".png": (b"\x89PNG",),
+    ".jpg": (b"\xff\xd8",),
+    ".jpeg": (b"\xff\xd8",),
+    ".tiff": (b"II*\x00", b"MM\x00*"),
+    ".bmp": (b"BM",),
+    ".docx": (b"PK\x03\x04",),
+    ".xlsx": (b"PK\x03\x04",),
+}
+
+def _matches_signature(filename, data):
+    """True se il contenuto corrisponde all'estensione (o l'estensione non ha firma)."""
+    ext = os.path.splitext(filename)[1].lower()
+    signatures = _FILE_SIGNATURES.get(ext)
+    if signatures is None:
+        return True
+    if ext == ".pdf":
+        # la specifica ammette byte spuri prima dell'header, entro i primi 1024
+        return b"%PDF" in data[:1024]
+    return data.startswith(signatures)
+
 @app.route("/")
 def home():
-    return render_template("index.html")
+    global _index_html
+    if _index_html is None:
+        _index_html = render_template("index.html")
+    return Response(_index_html, mimetype="text/html")
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
     try:
-        task_id = str(int(time.time() * 1000))  # Timestamp come ID
-        processing_status[task_id] = {"status": "starting", "start_time": time.time()}
+        # ID casuale (72 bit, URL-safe): niente collisioni fra upload nello stesso
+        # millisecondo e niente ID indovinabili per /check_status
+        task_id = secrets.token_urlsafe(9)
         
         files = request.files.getlist("file")
         if not files or not files[0].filename:
             return jsonify({"error": "Nessun file caricato"}), 400
             
-        # Controllo dimensioni
-        total_size = sum(file.content_length or 0 for file in files if file.content_length)
-        if total_size > 10 * 1024 * 1024:  # 10MB limit
-            return jsonify({"error": "File troppo grandi. Limite: 10MB totali"}), 400
+        # Legge i file in memoria: niente scrittura e rilettura da UPLOAD_FOLDER
+        uploads = [(file.filename, file.read()) for file in files if file.filename]
         
-        # Salva file e avvia elaborazione asincrona
-        filepaths = []
-        for file in files:
-            if file.filename:
-                filepath = os.path.join(UPLOAD_FOLDER, f"{task_id}_{file.filename}")
-                file.save(filepath)
-                filepaths.append(filepath)
+        # Controllo dimensioni (sui byte effettivi)
+        total_size = sum(len(data) for _, data in uploads)
+        if total_size > MAX_UPLOAD_BYTES:
+            return jsonify({"error": UPLOAD_TOO_LARGE_MESSAGE}), 400
+
+        invalid = [filename for filename, data in uploads if not _matches_signature(filename, data)]
+        if invalid:
+            return jsonify({"error": f"Contenuto non valido per il tipo di file: {', '.join(invalid)}"}), 415
+        
+        status = processing_status[task_id] = {"status": "starting", "start_time": time.time(),
+                                               "done_event": threading.Event()}
         
-        # Avvia thread di elaborazione
-        thread = threading.Thread(target=extract_text_from_files_thread, args=(filepaths, task_id))
-        thread.daemon = True
-        thread.start()
+        # Accoda l'elaborazione sul pool degli upload (il thread riceve direttamente lo
+        # status: se il task viene rimosso dallo store prima che parta, nessun KeyError)
+        UPLOAD_EXECUTOR.submit(extract_text_from_files_thread, uploads, task_id, status)
         
         return jsonify({"task_id": task_id, "status": "processing"})
         
+    except HTTPException:
+        # es. 413 sollevato da Werkzeug leggendo request.files: lo gestisce l'errorhandler
+        raise
     except Exception as e:
         logger.error(traceback.format_exc())
         return jsonify({"error": f"Errore upload: {str(e)}"}), 500
 
-def extract_text_from_files_thread(filepaths, task_id):
+def extract_text_from_files_thread(uploads, task_id, status):
     """
     Thread di coordinamento: elabora ogni file con extract_text_from_file_async e
-    aggrega i risultati nel task principale task_id.
+    aggrega i risultati in status, il dict del task principale task_id.
     """
     try:
-        texts = []
-        total_files = len(filepaths)
-        for idx, filepath in enumerate(filepaths):
+        total_files = len(uploads)
+        texts = [""] * total_files
+        # pagine già pronte, lette da /stream_status mentre l'elaborazione prosegue
+        pages = status.setdefault("pages", [])
+
+        def extract_one(idx):
+            filename, data = uploads[idx]
             file_task_id = f"{task_id}_file_{idx}"
-            # esegui sincronamente l'estrazione (funzione aggiorna processing_status[file_task_id])
-            extract_text_from_file_async(filepath, file_task_id)
 
-            # recupera risultato (già impostato dalla funzione)
-            res_info = processing_status.get(file_task_id, {})
-            texts.append(res_info.get("result", ""))
+            def on_page(page_index, text):
+                pages.append({"file": idx, "page": page_index + 1, "text": text})
 
-            # rimuovi file temporaneo
-            try:
-                os.remove(filepath)
-            except Exception:
-                logger.warning(f"Impossibile rimuovere file temporaneo: {filepath}")
+            # la funzione aggiorna processing_status[file_task_id]
+            extract_text_from_file_async(filename, data, file_task_id, on_page=on_page)
+
+            # recupera risultato (già impostato dalla funzione) e libera l'entry del singolo file
+            res_info = processing_status.pop(file_task_id, {})
+            file_text = res_info.get("result", "")
+            if total_files > 1:
+                # intestazione per file (come l'OCR lato client): un'unica chiamata Gemini
+                # analizza tutti i referti ma può ancora distinguerli
+                file_text = f"--- {filename} ---\n{file_text}"
+            texts[idx] = file_text
 
-            # aggiorna progresso complessivo
-            processing_status[task_id]["progress"] = int(((idx + 1) / max(total_files,1)) * 100)
+        # file estratti in parallelo (pool locale: l'OCR vero e proprio resta limitato
+        # da OCR_EXECUTOR); i testi restano nell'ordine di upload
+        with ThreadPoolExecutor(max_workers=min(total_files, FILE_WORKERS) or 1,
+                                thread_name_prefix="file") as executor:
+            futures = [executor.submit(extract_one, idx) for idx in range(total_files)]
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                # aggiorna progresso complessivo
+                status["progress"] = int((done / max(total_files,1)) * 100)
 
         full_text = "\n\n".join(texts)
-        processing_status[task_id]["status"] = "completed"
-        processing_status[task_id]["result"] = full_text
+        status["result"] = full_text
+        status["status"] = "completed"
+        # il risultato completo sostituisce le pagine parziali
+        status.pop("pages", None)
 
     except Exception as e:
         logger.error(traceback.format_exc())
-        processing_status[task_id]["status"] = "error"
-        processing_status[task_id]["result"] = str(e)
+        status["status"] = "error"
+        status["result"] = str(e)
+    finally:
+        # da qui decorre la scadenza del task nello store
+        status["end_time"] = time.time()
+        # sveglia chi è in long-polling su /check_status o /stream_status
+        status["done_event"].set()
 
 @app.route("/check_status/<task_id>", methods=["GET"])
 def check_status(task_id):
     """Controlla status elaborazione"""
-    if task_id not in processing_status:
+    info = processing_status.get(task_id)
+    if info is None:
         return jsonify({"error": "Task non trovato"}), 404
     
-    return jsonify(processing_status[task_id])
+    # long-polling: se il task è ancora in corso attende fino a CHECK_STATUS_WAIT secondi
+    # che finisca, così il client riceve il risultato appena pronto
+    done_event = info.get("done_event")
+    if done_event is not None and info.get("status") not in FINAL_TASK_STATES:
+        done_event.wait(timeout=CHECK_STATUS_WAIT)
+    
+    return jsonify(_public_task_info(info))
+
+@app.route("/stream_status/<task_id>", methods=["GET"])
+def stream_status(task_id):
+    """
+    Come /check_status ma in Server-Sent Events: invia il testo di ogni pagina
+    appena è pronto, poi il risultato completo.
+    """
+    if task_id not in processing_status:
+        return jsonify({"error": "Task non trovato"}), 404
+
+    def events():
+        sent_pages = 0
+        last_progress = None
+        deadline = time.time() + STREAM_STATUS_TIMEOUT
+        while time.time() < deadline:
+            info = processing_status.get(task_id)
+            if info is None:
+                yield _sse({"type": "error", "result": "Task non trovato"})
+                return
+
+            pages = info.get("pages", [])
+            while sent_pages < len(pages):
+                yield _sse({"type": "page", **pages[sent_pages]})
+                sent_pages += 1
+
+            status = info.get("status")
+            if status in FINAL_TASK_STATES:
+                yield _sse({"type": status, "result": info.get("result", "")})
+                return
+
+            if info.get("progress") != last_progress:
+                last_progress = info.get("progress")
+                yield _sse({"type": "progress", "progress": last_progress})
+            # esce subito dall'attesa quando il task termina
+            info["done_event"].wait(timeout=0.5)
+
+        yield _sse({"type": "timeout"})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/analyze", methods=["POST"])
 def analyze_text():
@@ -307,36 +1243,81 @@ def analyze_text():
         prompt_type = request.form.get("prompt_type", "simple")
         custom_prompt = request.form.get("custom_prompt", "")
         
-        prompt = get_prompt(prompt_type, custom_prompt, full_text)
+        prompt = get_prompt(prompt_type, custom_prompt, condense_text(full_text))
         summary = generate_summary(prompt)
         
         # Salva solo se riuscito
+        doc_id = None
         if not summary.startswith("⚠️"):
-            create_word_doc(summary, full_text)
+            doc_id = create_word_doc_async(summary, full_text)
         
-        return jsonify({"summary": summary, "status": "success"})
+        return jsonify({"summary": summary, "status": "success", "doc_id": doc_id})
         
     except Exception as e:
         logger.error(traceback.format_exc())
         return jsonify({"error": f"Errore analisi: {str(e)}"}), 500
 
+@app.route("/analyze_stream", methods=["POST"])
+def analyze_text_stream():
+    """Come /analyze, ma invia il riassunto come Server-Sent Events appena Gemini lo genera."""
+    full_text = request.form.get("extracted_text", "").strip()
+    if not full_text:
+        return jsonify({"error": "Nessun testo da analizzare"}), 400
+
+    prompt_type = request.form.get("prompt_type", "simple")
+    custom_prompt = request.form.get("custom_prompt", "")
+    def events():
+        parts = []
+        try:
+            prompt = get_prompt(prompt_type, custom_prompt, condense_text(full_text))
+            for text in stream_summary(prompt):
+                parts.append(text)
+                yield _sse({"text": text})
+        except Exception as e:
+            logger.error(f"Errore Gemini: {traceback.format_exc()}")
+            yield _sse({"error": GEMINI_ERROR_MESSAGE.format(str(e))})
+            return
+
+        doc_id = create_word_doc_async("".join(parts), full_text)
+        yield _sse({"done": True, "doc_id": doc_id})
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/download-summary")
-def download_summary():
-    file_path = os.path.join(ARCHIVE_FOLDER, "riassunto_referto.docx")
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
-    return jsonify({"error": "File non disponibile"}), 404
+@app.route("/download-summary/<doc_id>")
+def download_summary(doc_id=None):
+    # senza doc_id nessun documento: "l'ultimo generato" potrebbe essere di un altro utente
+    entry = word_docs.get(doc_id) if doc_id else None
+    if entry is None:
+        return jsonify({"error": "File non disponibile"}), 404
+    try:
+        data = entry["future"].result(timeout=10)
+    except FuturesTimeoutError:
+        # documento ancora in preparazione: il client riprova fra poco
+        return jsonify({"status": "processing"}), 202, {"Retry-After": "2"}
+    except Exception:
+        logger.error(traceback.format_exc())
+        return jsonify({"error": "File non disponibile"}), 404
+
+    # servito dalla memoria; doc_id (digest del contenuto) come ETag per 304 e Range
+    return send_file(io.BytesIO(data), mimetype=DOCX_MIMETYPE, as_attachment=True,
+                     download_name="riassunto_referto.docx", conditional=True, etag=doc_id)
 
 @app.route("/reset", methods=["POST"])
 def reset():
     try:
-        # Pulisci cartelle e status
-        for folder in [UPLOAD_FOLDER, ARCHIVE_FOLDER]:
+        # Pulisci cartelle e status (comprese le cache di OCR e riassunti)
+        for folder in [UPLOAD_FOLDER, ARCHIVE_FOLDER, CACHE_FOLDER]:
             if os.path.exists(folder):
                 shutil.rmtree(folder)
                 os.makedirs(folder)
+        os.makedirs(OCR_CACHE_FOLDER, exist_ok=True)
+        with _summary_cache_lock:
+            _summary_cache.clear()
         
         processing_status.clear()
+        word_docs.clear()
         logger.info("Reset completato")
         return jsonify({"status": "reset_done"})
         
@@ -344,11 +1325,15 @@ def reset():
         logger.error(traceback.format_exc())
         return jsonify({"error": str(e)}), 500
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": UPLOAD_TOO_LARGE_MESSAGE}), 413
+
 @app.route("/health")
 def health():
     return jsonify({"status": "OK", "timestamp": str(datetime.now())})
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
-    # Configurazione ottimizzata per Render
+    # Solo per sviluppo locale: nel container l'app gira sotto gunicorn (vedi Dockerfile)
     app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
@@ -3,19 +3,28 @@
 Script per testare l'app su Render e diagnosticare problemi
 """
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import json
 
 # Sostituisci con il tuo URL Render - lo trovi su Render Dashboard
 RENDER_URL = "https://referto-app.onrender.com"  # CAMBIA QUESTO!
 
+# Una sola sessione per tutte le richieste: la connessione TLS viene riusata
+# (niente handshake a ogni status check); retry sui 502/503/504 del cold start
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10,
+                                      max_retries=Retry(total=3, backoff_factor=0.5,
+                                                        status_forcelist=[502, 503, 504])))
+
 def test_endpoints():
     print("🧪 Test endpoints Render...")
     
     # Test 1: Health check
     try:
         print("\n1️⃣ Test Health Check...")
-        response = requests.get(f"{RENDER_URL}/health", timeout=30)
+        response = session.get(f"{RENDER_URL}/health", timeout=30)
         print(f"Status: {response.status_code}")
         print(f"Response: {response.json()}")
     except Exception as e:
@@ -25,7 +34,7 @@ def test_endpoints():
     # Test 2: Home page
     try:
         print("\n2️⃣ Test Home Page...")
-        response = requests.get(RENDER_URL, timeout=30)
+        response = session.get(RENDER_URL, timeout=30)
         print(f"Status: {response.status_code}")
         print(f"Content length: {len(response.text)} chars")
     except Exception as e:
@@ -39,7 +48,7 @@ def test_endpoints():
         test_content = "Referto di test\nPaziente: Mario Rossi\nEsami del sangue: tutto nella norma"
         files = {'file': ('test.txt', test_content.encode(), 'text/plain')}
         
-        response = requests.post(f"{RENDER_URL}/upload", files=files, timeout=45)
+        response = session.post(f"{RENDER_URL}/upload", files=files, timeout=45)
         print(f"Upload Status: {response.status_code}")
         
         if response.status_code == 200:
@@ -51,7 +60,7 @@ def test_endpoints():
                 task_id = data['task_id']
                 for i in range(10):  # Aspetta max 30 secondi
                     time.sleep(3)
-                    status_resp = requests.get(f"{RENDER_URL}/check_status/{task_id}", timeout=15)
+                    status_resp = session.get(f"{RENDER_URL}/check_status/{task_id}", timeout=15)
                     status_data = status_resp.json()
                     print(f"Status check {i+1}: {status_data.get('status')}")
                     
@@ -75,7 +84,7 @@ def monitor_cold_start():
     start_time = time.time()
     
     try:
-        response = requests.get(f"{RENDER_URL}/health", timeout=60)
+        response = session.get(f"{RENDER_URL}/health", timeout=60)
         end_time = time.time()
         
         print(f"Cold start time: {end_time - start_time:.2f} secondi")